@@ -1,62 +1,185 @@
 from flask import Flask, render_template, request, jsonify
-from transformers import pipeline
-import json
-import hashlib
+from markupsafe import escape
+from transformers import AutoModelForCausalLM, AutoTokenizer
+import blake3
+import torch
+import concurrent.futures
+from dataclasses import dataclass, fields
+import functools
+import mmap
 import os
+import orjson
 import re
+import sqlite3
+import string
+import threading
+import time
+import uuid
 from langchain.prompts import PromptTemplate
 
 app = Flask(__name__)
 
 # Load the AI model
-generator = pipeline("text-generation", model="gpt2")  # Use GPT-2 as a placeholder
+# Optionally load the weights in bfloat16 to halve memory traffic on the decode matmuls; set USE_BF16=1
+# only on CPUs with native bf16 (AVX512-BF16 or AMX), since elsewhere it is emulated and slower than fp32
+MODEL_DTYPE = torch.bfloat16 if os.environ.get("USE_BF16") == "1" else torch.float32
+tokenizer = AutoTokenizer.from_pretrained("gpt2")
+model = AutoModelForCausalLM.from_pretrained("gpt2", torch_dtype=MODEL_DTYPE)  # Use GPT-2 as a placeholder
+model.eval()
+# GPT-2 has no pad token; reuse EOS and pad on the left so prompts can be batched
+tokenizer.pad_token = tokenizer.eos_token
+tokenizer.padding_side = "left"
+
+# Optionally optimize the model with Intel Extension for PyTorch on CPU hosts; set USE_IPEX=1
+if os.environ.get("USE_IPEX") == "1":
+    import intel_extension_for_pytorch as ipex
+
+    # Follow USE_BF16 rather than forcing bf16, which is emulated on CPUs without native support
+    model = ipex.optimize(model, dtype=MODEL_DTYPE)
+    print("Generator optimized with IPEX.")
+
+# Optionally compile the model; set COMPILE_MODEL=1 (off by default so dev reloads stay fast)
+if os.environ.get("COMPILE_MODEL") == "1":
+    # Compile forward itself, since generate() calls the module's own forward
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
 print("Generator loaded successfully.")
 
-# JSON File for storing reports
-REPORTS_FILE = "investment_reports.json"
+# SQLite database for storing reports (WAL mode: readers never block the writer)
+REPORTS_DB = "investment_reports.db"
+# Earlier JSON Lines archive, imported into the database on first start
+REPORTS_FILE = "investment_reports.jsonl"
+
+# Background worker for report generation; a single worker since the model is shared
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# Maximum number of reports queued or in progress at once
+MAX_PENDING_REPORTS = 8
+PENDING_SLOTS = threading.BoundedSemaphore(MAX_PENDING_REPORTS)
+# Submitted report jobs, keyed by job ID: (future, submit time)
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+# Finished jobs are dropped this many seconds after submission
+JOB_TTL_SECONDS = 3600
+
+# New-token budget per report section
+MAX_NEW_TOKENS = {
+    "portfolio_summary": 300,
+    "client_insights": 250,
+    "recommendations": 250,
+    "disclosures": 200,
+}
+
+# Pattern used to cut the portfolio summary before the trailing instructions/labels
+SUMMARY_PATTERN = re.compile(r"(.*)(?:Instructions:|1\.|[A-Z][a-z]+\s*:)", re.DOTALL)
+
+# Control characters stripped before hashing (whitespace is collapsed separately)
+CONTROL_CHARS = dict.fromkeys([c for c in range(32) if chr(c) not in "\t\n\r\x0b\x0c"] + [127])
+
+# Function to put report text in a canonical form, so identical reports get the same ID
+def normalize_report_text(report_text):
+    return " ".join(report_text.translate(CONTROL_CHARS).split())
 
 # Function to generate a unique hash for the report
 def generate_report_id(report_text):
-    return hashlib.sha256(report_text.encode()).hexdigest()
-
-# Function to save report to JSON file
+    report_text = normalize_report_text(report_text)
+    # BLAKE3 with a 32-byte digest: same ID length as SHA-256, SIMD-accelerated hashing
+    return blake3.blake3(report_text.encode()).hexdigest(32)
+
+# Per-thread database connections (the worker writes while request threads read)
+_db_local = threading.local()
+
+# Function to get this thread's database connection
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(REPORTS_DB)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
+# Function to create the reports table and import the legacy archive
+def init_db():
+    conn = get_db()
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS reports (id TEXT PRIMARY KEY, data BLOB)")
+
+    if conn.execute("SELECT 1 FROM reports LIMIT 1").fetchone() is None:
+        legacy_reports = read_reports_file(REPORTS_FILE)
+        if legacy_reports:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO reports (id, data) VALUES (?, ?)",
+                    ((report_id, orjson.dumps(report)) for report_id, report in legacy_reports.items()),
+                )
+            print(f"Imported {len(legacy_reports)} reports from {REPORTS_FILE}")
+
+# Function to save a report to the database
 def save_report(report_data):
     try:
-        # Load existing reports if file exists
-        if os.path.exists(REPORTS_FILE):
-            with open(REPORTS_FILE, "r") as f:
-                reports = json.load(f)
-        else:
-            reports = {}
-
-        # Add new report
+        # Single-row insert; no read-modify-write of the whole archive
         report_id = report_data["report_id"]
-        reports[report_id] = report_data
-
-        # Save back to file
-        with open(REPORTS_FILE, "w") as f:
-            json.dump(reports, f, indent=4)
+        with get_db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reports (id, data) VALUES (?, ?)",
+                (report_id, orjson.dumps(report_data)),
+            )
+        REPORTS_INDEX[report_id] = report_data
 
         print(f"Report saved successfully with ID: {report_id}")
     except Exception as e:
         print(f"Error saving report: {e}")
         raise
 
-# Function to load past reports
+# Function to load past reports, keyed by report ID
 def load_reports():
     try:
-        if os.path.exists(REPORTS_FILE):
-            with open(REPORTS_FILE, "r") as f:
-                return json.load(f)
-        return {}
+        reports = {}
+        # Iterate the cursor so rows are decoded as they stream in
+        for report_id, data in get_db().execute("SELECT id, data FROM reports"):
+            reports[report_id] = orjson.loads(data)
+        return reports
     except Exception as e:
         print(f"Error loading reports: {e}")
         return {}
 
+# Function to read reports from a JSON Lines file, keyed by report ID
+def read_reports_file(path):
+    try:
+        reports = {}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # Map the file read-only and let orjson parse each line in C
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                start = 0
+                end = len(buf)
+                while start < end:
+                    stop = buf.find(b"\n", start)
+                    if stop == -1:
+                        stop = end
+                    line = buf[start:stop]
+                    if line.strip():
+                        report = orjson.loads(line)
+                        reports[report["report_id"]] = report
+                    start = stop + 1
+        return reports
+    except Exception as e:
+        print(f"Error reading reports from {path}: {e}")
+        return {}
+
+# Function to force saved reports to disk by checkpointing the WAL
+def flush_reports():
+    get_db().execute("PRAGMA wal_checkpoint(FULL)")
+
+init_db()
+# In-memory index of saved reports, loaded once at startup and kept current by save_report
+REPORTS_INDEX = load_reports()
+
 # Dynamic prompt based on client risk tolerance
 def get_portfolio_summary_prompt(client_profile):
-    risk_tolerance = client_profile.get("risk_tolerance", "moderate")
-    
+    return _portfolio_summary_prompt(client_profile.get("risk_tolerance", "moderate"))
+
+# Build the portfolio summary prompt once per risk tolerance
+@functools.lru_cache(maxsize=8)
+def _portfolio_summary_prompt(risk_tolerance):
     if risk_tolerance == "conservative":
         risk_note = "Given the client's conservative risk tolerance, the focus is on capital preservation and low-risk investments."
     elif risk_tolerance == "aggressive":
@@ -92,14 +215,17 @@ Instructions:
 """
     )
 
+# The client insights and recommendations prompts share the same leading block
+# (client profile, risk metrics, market outlook) so backends with prefix caching can reuse it
+
 # Define the client insights prompt
 client_insights_prompt = PromptTemplate(
     input_variables=["client_profile", "portfolio_summary", "risk_metrics", "market_outlook"],
     template="""
 Client Profile: {client_profile}
-Portfolio Summary: {portfolio_summary}
 Risk Metrics: {risk_metrics}
 Market Outlook: {market_outlook}
+Portfolio Summary: {portfolio_summary}
 
 Instructions:
 - Analyze the client's profile and portfolio performance.
@@ -114,9 +240,9 @@ recommendations_prompt = PromptTemplate(
     input_variables=["client_profile", "portfolio_summary", "risk_metrics", "market_outlook"],
     template="""
 Client Profile: {client_profile}
-Portfolio Summary: {portfolio_summary}
 Risk Metrics: {risk_metrics}
 Market Outlook: {market_outlook}
+Portfolio Summary: {portfolio_summary}
 
 Instructions:
 - Provide actionable recommendations based on the client's profile and portfolio performance.
@@ -126,8 +252,17 @@ Instructions:
 """
 )
 
+# Raw template strings for the static prompts, encoded directly without LangChain
+CLIENT_INSIGHTS_TEMPLATE = client_insights_prompt.template
+RECOMMENDATIONS_TEMPLATE = recommendations_prompt.template
+
 # Compliance disclosures based on regulations
 def get_disclosures_prompt(region):
+    return _disclosures_prompt(region)
+
+# Build the disclosures prompt once per region
+@functools.lru_cache(maxsize=8)
+def _disclosures_prompt(region):
     if region == "US":
         compliance_note = "This report complies with SEC regulations, including disclosures on risk and performance."
     elif region == "EU":
@@ -149,95 +284,264 @@ Instructions:
 """
     )
 
+# Prompt arguments; unknown placeholders are left as-is instead of raising
+class SafeDict(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+# Report form input, validated once per request
+@dataclass(slots=True, frozen=True)
+class ReportInput:
+    portfolio_name: str = ""
+    client_name: str = ""
+    risk_tolerance: str = "moderate"
+    investment_goals: str = ""
+    benchmark: str = ""
+    asset_allocation: str = ""
+    return_net: str = ""
+    return_benchmark: str = ""
+    risk_metrics: str = ""
+    top_holdings: str = ""
+    underperforming_holdings: str = ""
+    investment_products: str = ""
+    market_outlook: str = ""
+    date_range: str = ""
+    region: str = "US"  # Default to US for compliance
+
+    @classmethod
+    def from_form(cls, form):
+        # Missing fields fall back to the dataclass defaults
+        return cls(**{f.name: form[f.name] for f in fields(cls) if f.name in form})
+
+    def validate(self):
+        if not all([self.portfolio_name, self.client_name, self.date_range]):
+            raise ValueError("Missing required fields: portfolio_name, client_name, or date_range.")
+
+    # Build the prompt arguments once; shared by every prompt in the report
+    def format_kwargs(self):
+        return SafeDict({
+            "portfolio_name": self.portfolio_name,
+            "client_profile": {
+                "name": self.client_name,
+                "risk_tolerance": self.risk_tolerance,
+                "investment_goals": self.investment_goals,
+            },
+            "benchmark": self.benchmark,
+            "asset_allocation": self.asset_allocation,
+            "return_net": self.return_net,
+            "return_benchmark": self.return_benchmark,
+            "risk_metrics": self.risk_metrics,
+            "top_holdings": self.top_holdings,
+            "underperforming_holdings": self.underperforming_holdings,
+            "investment_products": self.investment_products,
+            "market_outlook": self.market_outlook,
+            "date_range": self.date_range,
+            "region": self.region,
+        })
+
+# Split a template into pre-tokenized constant text and format fragments holding the {field} placeholders.
+# GPT-2's pre-tokenizer always splits before a whitespace character that follows a non-whitespace one,
+# so the template is only cut there; the literal text around each placeholder stays in its fragment
+# and is tokenized with the value, giving the same IDs as encoding the whole rendered string
+@functools.lru_cache(maxsize=16)
+def encode_template(template):
+    pieces = []  # (fragment has a placeholder, constant text, format fragment)
+    has_field, text, fragment = False, "", ""
+    previous = None  # last template character, None after a placeholder
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        for char in literal:
+            if char.isspace() and previous is not None and not previous.isspace():
+                pieces.append((has_field, text, fragment))
+                has_field, text, fragment = False, "", ""
+            text += char
+            fragment += char.replace("{", "{{").replace("}", "}}")
+            previous = char
+        if field_name is not None:
+            fragment += "{" + field_name + ("!" + conversion if conversion else "") + (":" + format_spec if format_spec else "") + "}"
+            has_field, previous = True, None
+    pieces.append((has_field, text, fragment))
+
+    # Merge neighbouring pieces of the same kind; constant runs are tokenized now
+    segments = []
+    for has_field, text, fragment in pieces:
+        if segments and segments[-1][0] == has_field:
+            segments[-1] = (has_field, segments[-1][1] + (fragment if has_field else text))
+        else:
+            segments.append((has_field, fragment if has_field else text))
+    return tuple(
+        fragment if has_field else tokenizer.encode(fragment, add_special_tokens=False)
+        for has_field, fragment in segments
+    )
+
+# Encode a prompt by splicing the encoded placeholder fragments between the pre-tokenized constant segments
+def encode_prompt(template, input_data):
+    segments = encode_template(template)
+
+    # Only the fragments holding placeholders are rendered and tokenized per request, in a single batched call
+    fragments = [segment.format_map(input_data) for segment in segments if isinstance(segment, str)]
+    fragment_ids = iter(tokenizer(fragments, add_special_tokens=False)["input_ids"] if fragments else [])
+    input_ids = []
+    for segment in segments:
+        input_ids.extend(next(fragment_ids) if isinstance(segment, str) else segment)
+    return input_ids
+
+# Pre-tokenize the static templates at startup
+encode_template(CLIENT_INSIGHTS_TEMPLATE)
+encode_template(RECOMMENDATIONS_TEMPLATE)
+
+# Run a batch of encoded prompts through the model in a single generate() call
+def generate_texts(prompt_ids, max_new_tokens):
+    # generate() takes one budget per call, so run the batch to the largest one
+    # and cut each row back to its own budget afterwards
+    batch_max_new_tokens = max(max_new_tokens)
+
+    # Left-truncate prompts so every batch keeps room for its budget within GPT-2's positions
+    max_prompt_length = model.config.n_positions - batch_max_new_tokens
+    prompt_ids = [ids[-max_prompt_length:] for ids in prompt_ids]
+
+    # Left-pad the pre-encoded prompts and call generate() directly, bypassing the pipeline
+    inputs = tokenizer.pad({"input_ids": prompt_ids}, return_tensors="pt").to(model.device)
+    # bf16 inference runs under CPU autocast so every op (including IPEX's kernels) sees bf16 activations
+    with torch.autocast("cpu", dtype=torch.bfloat16, enabled=MODEL_DTYPE == torch.bfloat16):
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=batch_max_new_tokens,
+            do_sample=False,  # Greedy decoding: faster, and identical inputs give identical reports
+            use_cache=True,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:].tolist()
+    return tokenizer.batch_decode(
+        [ids + tokens[:budget] for ids, tokens, budget in zip(prompt_ids, new_tokens, max_new_tokens)],
+        skip_special_tokens=True,
+    )
+
+# Warm up the compiled model through generate_texts, so the two-row, left-padded, masked batches
+# of real requests hit an already compiled graph and the first report does not pay the compile time
+if os.environ.get("COMPILE_MODEL") == "1":
+    generate_texts([
+        tokenizer.encode("Warm up the report generator before the first request.", add_special_tokens=False),
+        tokenizer.encode("Warm up.", add_special_tokens=False),
+    ], [8, 8])
+    print("Generator compiled successfully.")
+
+# Generate every report section and save the result; runs on the background worker
+def build_report(input_data):
+    # Generate portfolio summary and compliance disclosures together;
+    # disclosures do not depend on the summary
+    portfolio_summary_prompt = get_portfolio_summary_prompt(input_data["client_profile"])
+    disclosures_prompt = get_disclosures_prompt(input_data["region"])
+    portfolio_summary_text, disclosures = generate_texts([
+        encode_prompt(portfolio_summary_prompt.template, input_data),
+        encode_prompt(disclosures_prompt.template, input_data),
+    ], [MAX_NEW_TOKENS["portfolio_summary"], MAX_NEW_TOKENS["disclosures"]])
+
+    # Extract portfolio summary
+    match = SUMMARY_PATTERN.search(portfolio_summary_text)
+    portfolio_summary = match.group(1).strip() if match else portfolio_summary_text.strip()
+
+    input_data["portfolio_summary"] = portfolio_summary
+
+    # Generate client insights and recommendations from the summary
+    client_insights, recommendations = generate_texts([
+        encode_prompt(CLIENT_INSIGHTS_TEMPLATE, input_data),
+        encode_prompt(RECOMMENDATIONS_TEMPLATE, input_data),
+    ], [MAX_NEW_TOKENS["client_insights"], MAX_NEW_TOKENS["recommendations"]])
+
+    # Combine report sections
+    report_text = f"{portfolio_summary}\n{client_insights}\n{recommendations}\n{disclosures}"
+    report_id = generate_report_id(report_text)
+
+    # Save report
+    report_data = {
+        "report_id": report_id,
+        "portfolio_summary": portfolio_summary,
+        "client_insights": client_insights,
+        "recommendations": recommendations,
+        "disclosures": disclosures,
+        "input_data": input_data
+    }
+    # Save before the job completes, so a "done" report is always persisted
+    save_report(report_data)
+    return report_data
+
+# Queue a report on the background worker and return its job ID
+def submit_report(input_data):
+    if not PENDING_SLOTS.acquire(blocking=False):
+        raise RuntimeError("Too many reports are being generated, please try again shortly.")
+
+    job_id = uuid.uuid4().hex
+    future = EXECUTOR.submit(build_report, input_data)
+    future.add_done_callback(lambda _: PENDING_SLOTS.release())
+
+    now = time.monotonic()
+    with JOBS_LOCK:
+        # Drop expired finished jobs; saved reports stay reachable by report ID
+        for stale_id, (stale_future, submitted_at) in list(JOBS.items()):
+            if stale_future.done() and now - submitted_at > JOB_TTL_SECONDS:
+                del JOBS[stale_id]
+        JOBS[job_id] = (future, now)
+    return job_id
+
 # --- Flask Routes ---
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     report = None
-    report_id = None
+    job_id = None
 
     if request.method == "POST":
         try:
-            data = request.form
-            input_data = {
-                "portfolio_name": data.get("portfolio_name"),
-                "client_profile": {
-                    "name": data.get("client_name"),
-                    "risk_tolerance": data.get("risk_tolerance", "moderate"),
-                    "investment_goals": data.get("investment_goals"),
-                },
-                "benchmark": data.get("benchmark"),
-                "asset_allocation": data.get("asset_allocation"),
-                "return_net": data.get("return_net"),
-                "return_benchmark": data.get("return_benchmark"),
-                "risk_metrics": data.get("risk_metrics"),
-                "top_holdings": data.get("top_holdings"),
-                "underperforming_holdings": data.get("underperforming_holdings"),
-                "investment_products": data.get("investment_products"),
-                "market_outlook": data.get("market_outlook"),
-                "date_range": data.get("date_range"),
-                "region": data.get("region", "US")  # Default to US for compliance
-            }
+            report_input = ReportInput.from_form(request.form)
 
             # Debugging: Print input data
-            print("Input Data:", input_data)
+            print("Input Data:", report_input)
 
             # Validate required fields
-            if not all([input_data["portfolio_name"], input_data["client_profile"]["name"], input_data["date_range"]]):
-                raise ValueError("Missing required fields: portfolio_name, client_name, or date_range.")
-
-            # Generate portfolio summary with dynamic prompt
-            portfolio_summary_prompt = get_portfolio_summary_prompt(input_data["client_profile"])
-            portfolio_summary_text = generator(portfolio_summary_prompt.format(**input_data), max_length=1000)[0]['generated_text']
-
-            # Extract portfolio summary
-            match = re.search(r"(.*)(Instructions:|1\.|[A-Z][a-z]+\s*:)", portfolio_summary_text, re.DOTALL)
-            portfolio_summary = match.group(1).strip() if match else portfolio_summary_text.strip()
-
-            input_data["portfolio_summary"] = portfolio_summary
-
-            # Generate client insights
-            client_insights = generator(client_insights_prompt.format(**input_data), max_length=1000)[0]['generated_text']
-
-            # Generate recommendations
-            recommendations = generator(recommendations_prompt.format(**input_data), max_length=1000)[0]['generated_text']
-
-            # Generate compliance disclosures with region-specific prompt
-            disclosures_prompt = get_disclosures_prompt(input_data["region"])
-            disclosures = generator(disclosures_prompt.format(**input_data), max_length=1000)[0]['generated_text']
-
-            # Combine report sections
-            report_text = f"{portfolio_summary}\n{client_insights}\n{recommendations}\n{disclosures}"
-            report_id = generate_report_id(report_text)
-
-            # Save report
-            report_data = {
-                "report_id": report_id,
-                "portfolio_summary": portfolio_summary,
-                "client_insights": client_insights,
-                "recommendations": recommendations,
-                "disclosures": disclosures,
-                "input_data": input_data
-            }
-            save_report(report_data)
-
-            # Format report for display
-            report = f"""
-            <h2>Investment Report - {input_data['portfolio_name']} - {input_data['date_range']}</h2>
-            <h3>Report ID: {report_id}</h3>
-            <h3>Portfolio Performance Summary</h3>
-            <pre>{portfolio_summary}</pre>
-            <h3>Client-Specific Insights</h3>
-            <pre>{client_insights}</pre>
-            <h3>Recommendations and Outlook</h3>
-            <pre>{recommendations}</pre>
-            <h3>Compliance Disclosures</h3>
-            <pre>{disclosures}</pre>
-            """
-        except Exception as e:
-            report = f"<p style='color:red;'>Error generating report: {e}</p>"
+            report_input.validate()
 
-    return render_template("index.html", report=report, report_id=report_id)
+            # Generate the report in the background; the page polls for the result
+            job_id = submit_report(report_input.format_kwargs())
+        except Exception as e:
+            report = f"<p style='color:red;'>Error generating report: {escape(e)}</p>"
+
+    return render_template("index.html", report=report, job_id=job_id)
+
+@app.route("/report/<job_id>")
+def report_status(job_id):
+    # Finished jobs stay until the TTL sweep in submit_report, so a repeated poll gets the same answer
+    with JOBS_LOCK:
+        future, _ = JOBS.get(job_id, (None, None))
+
+    if future is None:
+        # Not a job ID; look it up as the ID of a saved report
+        report_data = REPORTS_INDEX.get(job_id)
+        if report_data is None:
+            return jsonify({"status": "not_found"}), 404
+    elif not future.done():
+        return jsonify({"status": "pending"}), 202
+    else:
+        try:
+            report_data = future.result()
+        except Exception as e:
+            return jsonify({
+                "status": "error",
+                "report": f"<p style='color:red;'>Error generating report: {escape(e)}</p>",
+            }), 500
+
+    return jsonify({
+        "status": "done",
+        "report_id": report_data["report_id"],
+        "report": render_template("_report.html", **report_data),
+    })
+
+@app.route("/flush", methods=["POST"])
+def flush():
+    try:
+        flush_reports()
+        return jsonify({"status": "ok"})
+    except Exception as e:
+        return jsonify({"status": "error", "error": str(e)}), 500
 
 # --- Run the App ---
 